@@ -1,12 +1,30 @@
 import os
+import re
+import asyncio
+import glob
+import json
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import compress
+from operator import attrgetter, itemgetter
+import orjson
+import msgspec
 from dotenv import load_dotenv
 import snowflake.connector
 import uvicorn
+import onnx
 import onnxruntime as ort
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from onnxconverter_common import float16
 import numpy as np
-from fastapi import FastAPI
-from pydantic import BaseModel
+from stage_listing import latest_stage_file, parse_stage_timestamp
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.openapi.utils import validation_error_definition
+from fastapi.responses import JSONResponse
 
 # --- Load environment variables ---
 load_dotenv()
@@ -19,83 +37,393 @@ SNOWFLAKE_WAREHOUSE = os.getenv("SNOWFLAKE_WAREHOUSE", "MLOPS_WH")
 SNOWFLAKE_DATABASE = os.getenv("SNOWFLAKE_DATABASE", "POWERCONSUMPTION")
 SNOWFLAKE_SCHEMA = os.getenv("SNOWFLAKE_SCHEMA", "PUBLIC")
 SNOWFLAKE_STAGE = os.getenv("SNOWFLAKE_STAGE", "ML_MODELS_STAGE")
+FULL_STAGE_PATH = f"{SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{SNOWFLAKE_STAGE}"
+# Seconds between checks for a new model on the stage (0 disables the watcher)
+MODEL_WATCH_INTERVAL_S = int(os.getenv("MODEL_WATCH_INTERVAL_S", "60"))
 LOCAL_MODEL_DIR = "./models"
+MODEL_MANIFEST_PATH = os.path.join(LOCAL_MODEL_DIR, ".manifest.json")
+
+# --- Dynamic Batching Configuration ---
+MAX_BATCH = int(os.getenv("MAX_BATCH", "32"))
+BATCH_TIMEOUT_MS = float(os.getenv("BATCH_TIMEOUT_MS", "5"))
+
+# Column order the model was trained on
+FEATURE_NAMES = (
+    "TEMPERATURE", "HUMIDITY", "WINDSPEED",
+    "GENERALDIFFUSEFLOWS", "DIFFUSEFLOWS", "HOUR",
+    "DAYOFWEEK", "QUARTER", "MONTH", "DAYOFYEAR",
+    "POWER_LAG_1", "POWER_LAG_144",
+    "POWER_ROLLING_MEAN_6", "POWER_ROLLING_MEAN_24"
+)
+NUM_FEATURES = len(FEATURE_NAMES)
+
+# --- Prediction Cache Configuration ---
+# Recent predictions are reused for inputs that land on the same grid point
+# after snapping every feature to its step. Off by default (0 entries); when
+# enabled the model is run on the snapped row, so answers are deterministic.
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "0"))
+# Multiplies every step below, for a coarser (> 1) or finer (< 1) grid
+PREDICTION_CACHE_STEP_SCALE = float(os.getenv("PREDICTION_CACHE_STEP_SCALE", "1"))
+# Grid step per feature, sized to each feature's typical scale
+PREDICTION_CACHE_STEPS = {
+    "TEMPERATURE": 0.1, "HUMIDITY": 0.1, "WINDSPEED": 0.01,
+    "GENERALDIFFUSEFLOWS": 0.1, "DIFFUSEFLOWS": 0.1, "HOUR": 1,
+    "DAYOFWEEK": 1, "QUARTER": 1, "MONTH": 1, "DAYOFYEAR": 1,
+    "POWER_LAG_1": 10, "POWER_LAG_144": 10,
+    "POWER_ROLLING_MEAN_6": 10, "POWER_ROLLING_MEAN_24": 10
+}
+FEATURE_CACHE_STEPS = tuple(PREDICTION_CACHE_STEPS[name] * PREDICTION_CACHE_STEP_SCALE for name in FEATURE_NAMES)
+
+# --- Server Configuration ---
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", max(1, (os.cpu_count() or 1) // 2)))
+
+# --- ONNX Runtime Configuration ---
+# Each worker process runs a pool of sessions that split the cores between
+# them, so every session gets a single intra-op thread by default
+ORT_SESSION_POOL_SIZE = int(os.getenv("ORT_SESSION_POOL_SIZE", max(1, (os.cpu_count() or 1) // UVICORN_WORKERS)))
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", "1"))
+# Pin each session's thread to one core (Linux only; best with a single worker)
+ORT_PIN_THREADS = os.getenv("ORT_PIN_THREADS", "false").lower() == "true"
+# Precision the model is served at: "int8", "fp16" or "fp32"
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "int8").lower()
+QUANTIZABLE_OPS = {"MatMul", "Gemm", "Conv", "Attention", "LSTM", "GRU", "Gather"}
+
+
+# --- Function to Open a Snowflake Connection ---
+def connect_to_snowflake():
+    """
+    Opens a new Snowflake connection with the configured credentials.
+    """
+    print("🔗 Connecting to Snowflake...")
+    conn = snowflake.connector.connect(
+        user=SNOWFLAKE_USER,
+        password=SNOWFLAKE_PASSWORD,
+        account=SNOWFLAKE_ACCOUNT,
+        warehouse=SNOWFLAKE_WAREHOUSE,
+        database=SNOWFLAKE_DATABASE,
+        schema=SNOWFLAKE_SCHEMA
+    )
+    print("✅ Connection successful.")
+    return conn
+
+
+# --- Local Manifest of the Last Downloaded Model ---
+def read_model_manifest():
+    """
+    Returns the manifest written after the last successful download,
+    or None if there is none (or it cannot be read).
+    """
+    try:
+        with open(MODEL_MANIFEST_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_model_manifest(name, last_modified, md5):
+    """
+    Records which stage file is currently present in LOCAL_MODEL_DIR.
+    `last_modified` is LIST's last_modified column.
+    """
+    last_modified_iso = datetime(*parse_stage_timestamp(last_modified)).isoformat()
+    tmp_path = f"{MODEL_MANIFEST_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"name": name, "last_modified_iso": last_modified_iso, "md5": md5}, f)
+    os.replace(tmp_path, MODEL_MANIFEST_PATH)
 
 
 # --- Function to Download Latest Model from Snowflake ---
 def download_latest_onnx_model():
     """
     Connects to Snowflake, finds the latest ONNX model on the stage,
-    downloads it to a local directory, and returns the path.
+    downloads it to a local directory, and returns (path, (name, md5)) of
+    the stage file it served, or (None, None) on failure.
+    The GET is skipped if the local copy already matches the stage file.
     """
     conn = None
     try:
-        print("🔗 Connecting to Snowflake...")
-        conn = snowflake.connector.connect(
-            user=SNOWFLAKE_USER,
-            password=SNOWFLAKE_PASSWORD,
-            account=SNOWFLAKE_ACCOUNT,
-            warehouse=SNOWFLAKE_WAREHOUSE,
-            database=SNOWFLAKE_DATABASE,
-            schema=SNOWFLAKE_SCHEMA
-        )
-        print("✅ Connection successful.")
-
+        conn = connect_to_snowflake()
         cur = conn.cursor()
+        cur.execute("ALTER SESSION SET QUERY_TAG='model_sync'")
 
         # Ensure correct database/schema context
         print(f"📂 Setting context to {SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}")
         cur.execute(f"USE DATABASE {SNOWFLAKE_DATABASE}")
         cur.execute(f"USE SCHEMA {SNOWFLAKE_SCHEMA}")
 
-        # Fully qualified stage path
-        full_stage_path = f"{SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{SNOWFLAKE_STAGE}"
-
-        print(f"📂 Listing files in stage '@{full_stage_path}'...")
-        cur.execute(f"LIST @{full_stage_path}")
-        all_files = cur.fetchall()
+        print(f"📂 Listing files in stage '@{FULL_STAGE_PATH}'...")
+        cur.execute(f"LIST @{FULL_STAGE_PATH} PATTERN='.*[.]onnx'")
 
-        # Filter .onnx files and pick the most recent
-        onnx_files = []
-        for file_row in all_files:
-            file_name, _, _, last_modified_str = file_row
-            if file_name.endswith(".onnx"):
-                last_modified_dt = datetime.strptime(
-                    last_modified_str, "%a, %d %b %Y %H:%M:%S %Z"
-                )
-                onnx_files.append((file_name, last_modified_dt))
+        # Pick the most recent .onnx file the same way the stage watcher does
+        latest_file = latest_stage_file(cur.fetchall())
 
-        if not onnx_files:
+        if not latest_file:
             print("⚠️ No .onnx files found on stage.")
-            return None
+            return None, None
 
-        onnx_files.sort(key=lambda x: x[1], reverse=True)
-        latest_file_full_path = onnx_files[0][0]
+        latest_file_full_path, _, latest_md5, latest_modified = latest_file
         latest_file_name = os.path.basename(latest_file_full_path)
+        stage_file = (latest_file_name, latest_md5)
         print(f"✅ Found latest model: {latest_file_name}")
 
         os.makedirs(LOCAL_MODEL_DIR, exist_ok=True)
         local_directory_path = os.path.abspath(LOCAL_MODEL_DIR).replace("\\", "/")
-        get_command = f"GET @{full_stage_path}/{latest_file_name} file://{local_directory_path}"
+        final_path = os.path.join(local_directory_path, latest_file_name)
+
+        # Skip the download if the local copy is the same stage file
+        manifest = read_model_manifest()
+        if (
+            manifest
+            and manifest.get("name") == latest_file_name
+            and manifest.get("md5") == latest_md5
+            and os.path.exists(final_path)
+        ):
+            print(f"♻️ Local model is up to date, skipping download: {final_path}")
+            return final_path, stage_file
+
+        # Download into a per-process directory and move the file into place,
+        # so concurrent workers never read a partially written model
+        download_directory_path = f"{local_directory_path}/.download-{os.getpid()}"
+        os.makedirs(download_directory_path, exist_ok=True)
+        get_command = f"GET @{FULL_STAGE_PATH}/{latest_file_name} file://{download_directory_path}"
 
         print(f"⬇️ Executing download command: {get_command}")
         cur.execute(get_command)
+        os.replace(os.path.join(download_directory_path, latest_file_name), final_path)
+        shutil.rmtree(download_directory_path, ignore_errors=True)
 
-        final_path = os.path.join(local_directory_path, latest_file_name)
+        write_model_manifest(latest_file_name, latest_modified, latest_md5)
         print(f"✅ Model downloaded to: {final_path}")
-        return final_path
+        return final_path, stage_file
 
     except Exception as e:
         print(f"❌ Error during model download: {e}")
-        return None
+        return None, None
     finally:
         if conn:
             conn.close()
             print("🔒 Connection closed.")
 
 
+# --- Function to Quantize the Model Weights to INT8 ---
+def quantize_model(model_path):
+    """
+    Returns the path of an INT8 dynamically-quantized copy of the model,
+    creating it next to the original if needed. Falls back to the FP32
+    model when the graph has no quantizable ops (e.g. tree ensembles)
+    or quantization fails.
+    """
+    int8_path = model_path + ".int8.onnx"
+    if os.path.exists(int8_path) and os.path.getmtime(int8_path) >= os.path.getmtime(model_path):
+        print(f"♻️ Reusing INT8 model: {int8_path}")
+        return int8_path
+
+    try:
+        op_types = {node.op_type for node in onnx.load(model_path).graph.node}
+        if not op_types & QUANTIZABLE_OPS:
+            print(f"ℹ️ No quantizable ops in model ({', '.join(sorted(op_types))}), serving FP32.")
+            return model_path
+
+        tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+        quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+        print(f"✅ INT8 model saved to: {int8_path}")
+        return int8_path
+    except Exception as e:
+        print(f"❌ INT8 quantization failed, serving FP32: {e}")
+        return model_path
+
+
+# --- Function to Convert the Model Weights to FP16 ---
+def convert_model_fp16(model_path):
+    """
+    Returns the path of an FP16 copy of the model, creating it next to the
+    original if needed. Inputs and outputs stay FP32 so callers are not
+    affected. Falls back to the FP32 model when every op is from the
+    ai.onnx.ml domain (e.g. tree ensembles), which has no FP16 kernels,
+    or conversion fails.
+    """
+    fp16_path = model_path + ".fp16.onnx"
+    if os.path.exists(fp16_path) and os.path.getmtime(fp16_path) >= os.path.getmtime(model_path):
+        print(f"♻️ Reusing FP16 model: {fp16_path}")
+        return fp16_path
+
+    try:
+        model = onnx.load(model_path)
+        if all(node.domain not in ("", "ai.onnx") for node in model.graph.node):
+            print("ℹ️ Model only uses ai.onnx.ml ops, serving FP32.")
+            return model_path
+
+        model_fp16 = float16.convert_float_to_float16(model, keep_io_types=True)
+        tmp_path = f"{fp16_path}.{os.getpid()}.tmp"
+        onnx.save(model_fp16, tmp_path)
+        os.replace(tmp_path, fp16_path)
+        print(f"✅ FP16 model saved to: {fp16_path}")
+        return fp16_path
+    except Exception as e:
+        print(f"❌ FP16 conversion failed, serving FP32: {e}")
+        return model_path
+
+
+def prepare_serving_model(model_path):
+    """
+    Returns the path of the model variant to serve for MODEL_PRECISION.
+    """
+    if MODEL_PRECISION == "int8":
+        return quantize_model(model_path)
+    if MODEL_PRECISION == "fp16":
+        return convert_model_fp16(model_path)
+    return model_path
+
+
+# --- Function to Build an Optimized ONNX Runtime Session ---
+def build_session_options(optimization_level):
+    """
+    Returns SessionOptions with fixed thread pools and the given graph
+    optimization level.
+    """
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = ORT_INTRA_OP_THREADS
+    so.inter_op_num_threads = 1
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.add_session_config_entry("session.intra_op.allow_spinning", "1")
+    so.graph_optimization_level = optimization_level
+    return so
+
+
+def create_inference_session(model_path):
+    """
+    Loads the model with full graph optimizations and fixed thread pools.
+    The portable (ORT_ENABLE_EXTENDED) optimized graph is saved next to the
+    model on first load and reused on later boots, so only the
+    hardware-specific passes run at load time. The cache file is keyed by
+    the ORT version and rebuilt from the source model if it cannot be read.
+    """
+    optimized_path = f"{model_path}.ort-{ort.__version__}.opt.onnx"
+
+    if os.path.exists(optimized_path) and os.path.getmtime(optimized_path) >= os.path.getmtime(model_path):
+        try:
+            session = ort.InferenceSession(
+                optimized_path,
+                sess_options=build_session_options(ort.GraphOptimizationLevel.ORT_ENABLE_ALL),
+                providers=["CPUExecutionProvider"]
+            )
+            print(f"♻️ Reusing optimized model: {optimized_path}")
+            return session
+        except Exception as e:
+            print(f"⚠️ Cached optimized model is unusable, rebuilding: {e}")
+
+    # Serialize to a per-process temp file and move it into place, so a crash
+    # or a concurrent worker never leaves a truncated cache file behind
+    try:
+        tmp_path = f"{optimized_path}.{os.getpid()}.tmp"
+        so = build_session_options(ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED)
+        so.optimized_model_filepath = tmp_path
+        ort.InferenceSession(model_path, sess_options=so, providers=["CPUExecutionProvider"])
+        os.replace(tmp_path, optimized_path)
+        print(f"✅ Optimized model saved to: {optimized_path}")
+        source_path = optimized_path
+    except Exception as e:
+        print(f"⚠️ Could not save optimized model, loading source model: {e}")
+        source_path = model_path
+
+    return ort.InferenceSession(
+        source_path,
+        sess_options=build_session_options(ort.GraphOptimizationLevel.ORT_ENABLE_ALL),
+        providers=["CPUExecutionProvider"]
+    )
+
+
+# --- A Loaded Model: Session Plus Its Bound I/O ---
+class SessionShard:
+    """
+    One InferenceSession with its own batch buffers and bound I/O, so
+    shards can run batches at the same time without sharing memory.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        self.output_name = session.get_outputs()[0].name
+        self.input_buf = np.zeros((MAX_BATCH, NUM_FEATURES), dtype=np.float32)
+        self.output_buf = np.zeros((MAX_BATCH, 1), dtype=np.float32)
+
+        # One ready-made binding per batch size. The OrtValues are views over
+        # input_buf/output_buf, so writes to the buffers are seen by ORT and
+        # nothing is wrapped, bound or allocated per call.
+        self.input_values = [None]
+        self.output_values = [None]
+        self.bindings = [None]
+        for n in range(1, MAX_BATCH + 1):
+            input_value = ort.OrtValue.ortvalue_from_numpy(self.input_buf[:n], "cpu", 0)
+            output_value = ort.OrtValue.ortvalue_from_numpy(self.output_buf[:n], "cpu", 0)
+            binding = session.io_binding()
+            binding.bind_ortvalue_input(self.input_name, input_value)
+            binding.bind_ortvalue_output(self.output_name, output_value)
+            self.input_values.append(input_value)
+            self.output_values.append(output_value)
+            self.bindings.append(binding)
+
+    def run(self, n):
+        """
+        Runs the session on the first n rows of input_buf; predictions are
+        written in place to the first n rows of output_buf.
+        """
+        self.session.run_with_iobinding(self.bindings[n])
+
+
+class LoadedModel:
+    """
+    The pool of session shards for one model file, so a reloaded model can
+    replace the current one with a single reference swap. Its prediction
+    cache goes with it, so a reload never serves stale predictions.
+    `stage_file` is the (name, md5) of the stage file it was built from.
+    """
+
+    def __init__(self, model_path, sessions, stage_file=None):
+        self.model_path = model_path
+        self.stage_file = stage_file
+        self.shards = [SessionShard(session) for session in sessions]
+        self.prediction_cache = OrderedDict()
+
+
+def build_model(local_model_path, stage_file=None):
+    """
+    Prepares the configured precision variant of a downloaded model and
+    loads ORT_SESSION_POOL_SIZE sessions of it into a LoadedModel. Falls
+    back to the FP32 model if ORT cannot load the variant.
+    """
+    serving_model_path = prepare_serving_model(local_model_path)
+    try:
+        sessions = [create_inference_session(serving_model_path) for _ in range(ORT_SESSION_POOL_SIZE)]
+    except Exception as e:
+        if serving_model_path == local_model_path:
+            raise
+        print(f"❌ Failed to load {MODEL_PRECISION.upper()} model, serving FP32: {e}")
+        # Drop the broken variant so the next build recreates it instead of reusing it
+        try:
+            os.remove(serving_model_path)
+        except OSError:
+            pass
+        sessions = [create_inference_session(local_model_path) for _ in range(ORT_SESSION_POOL_SIZE)]
+    return LoadedModel(local_model_path, sessions, stage_file)
+
+
+def remove_model_files(model_path):
+    """
+    Deletes a downloaded model and everything derived from it (precision
+    variants, optimized-graph caches), once it is no longer being served.
+    """
+    escaped_path = glob.escape(model_path)
+    for path in glob.glob(escaped_path) + glob.glob(f"{escaped_path}.*"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
 # --- Input Schema for Prediction Endpoint ---
-class InputFeatures(BaseModel):
+class InputFeatures(msgspec.Struct, frozen=True):
     TEMPERATURE: float
     HUMIDITY: float
     WINDSPEED: float
@@ -112,32 +440,389 @@ class InputFeatures(BaseModel):
     POWER_ROLLING_MEAN_24: float
 
 
+def validation_error_details(e):
+    """
+    Converts a msgspec decode/validation error into FastAPI's error list
+    ({"loc", "msg", "type"} entries), so 422 bodies keep Pydantic's shape.
+    """
+    if not isinstance(e, msgspec.ValidationError):
+        return [{"type": "json_invalid", "loc": ["body"], "msg": str(e)}]
+
+    msg, _, path = str(e).partition(" - at `")
+    loc = ["body"]
+    for name, index in re.findall(r"\.([^.\[`]+)|\[(\d+)\]", path):
+        loc.append(name or int(index))
+
+    missing = re.match(r"Object missing required field `(.+)`", msg)
+    if missing:
+        return [{"type": "missing", "loc": loc + [missing.group(1)], "msg": "Field required"}]
+
+    expected = re.match(r"Expected `(\w+)`", msg)
+    error_type = f"{expected.group(1)}_type" if expected else "value_error"
+    return [{"type": error_type, "loc": loc, "msg": msg}]
+
+
+async def parse_features(request: Request) -> InputFeatures:
+    """
+    Decodes and validates the request body straight into InputFeatures.
+    Numeric strings are coerced like Pydantic's lax mode did.
+    """
+    body = await request.body()
+    try:
+        return msgspec.json.decode(body, type=InputFeatures, strict=False)
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        raise RequestValidationError(validation_error_details(e), body=body)
+
+
+# JSON schema of the request body, for the OpenAPI docs
+INPUT_FEATURES_SCHEMA = msgspec.json.schema_components(
+    [InputFeatures], ref_template="#/components/schemas/{name}"
+)[1]["InputFeatures"]
+
+# The 422 response FastAPI documents for validated bodies, inlined because
+# /predict declares its body through openapi_extra
+VALIDATION_ERROR_RESPONSE = {
+    "description": "Validation Error",
+    "content": {
+        "application/json": {
+            "schema": {
+                "title": "HTTPValidationError",
+                "type": "object",
+                "properties": {"detail": {"title": "Detail", "type": "array", "items": validation_error_definition}}
+            }
+        }
+    }
+}
+
+# Pull the features out in FEATURE_NAMES order as a single C-level call
+features_from_model = attrgetter(*FEATURE_NAMES)
+features_from_dict = itemgetter(*FEATURE_NAMES)
+
+
 # --- FastAPI App ---
-app = FastAPI(title="Power Consumption Predictor API", version="1.0")
+class OrjsonResponse(JSONResponse):
+    """
+    JSON response rendered with orjson, which is faster than the standard
+    json module for the small dicts the endpoints return. Subclassing
+    JSONResponse keeps the OpenAPI docs describing the bodies as JSON.
+    """
+
+    def render(self, content):
+        return orjson.dumps(content)
+
+
+app = FastAPI(
+    title="Power Consumption Predictor API",
+    version="1.0",
+    default_response_class=OrjsonResponse
+)
 
 # Globals for model session
-ort_session = None
-input_name = None
+loaded_model = None
+model_task = None
+MODEL_READY = asyncio.Event()
 
+# Globals for the stage watcher
+watcher_thread = None
+watcher_stop = threading.Event()
 
-@app.on_event("startup")
-def startup_event():
+# Globals for the request batcher
+request_queue = None
+batch_tasks = []
+shard_executors = []
+
+
+def pin_thread_to_core(core):
     """
-    On startup, download the latest model and load it into memory.
+    Executor initializer: pins the calling thread to one CPU core so its
+    shard keeps reusing the same L2 cache.
     """
-    global ort_session, input_name
-    print("🚀 Starting FastAPI Server — initializing model...")
-    local_model_path = download_latest_onnx_model()
+    os.sched_setaffinity(0, {core})
+
+
+def create_shard_executor(index):
+    """
+    Returns the single-thread executor that runs shard `index`'s batches,
+    pinned to a core when ORT_PIN_THREADS is enabled and supported.
+    """
+    if ORT_PIN_THREADS and hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        return ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix=f"ort-shard-{index}",
+            initializer=pin_thread_to_core,
+            initargs=(cores[index % len(cores)],)
+        )
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"ort-shard-{index}")
 
-    if local_model_path and os.path.exists(local_model_path):
+
+async def batch_worker(index):
+    """
+    Collects concurrent /predict requests into one (B, 14) tensor and runs
+    it on session shard `index` once per batch instead of once per request.
+    One worker runs per shard, all pulling from the same queue, so an idle
+    shard picks up the next batch as soon as it is free.
+    """
+    loop = asyncio.get_running_loop()
+    executor = shard_executors[index]
+    timeout = BATCH_TIMEOUT_MS / 1000.0
+
+    while True:
+        batch = [await request_queue.get()]
         try:
-            ort_session = ort.InferenceSession(local_model_path, providers=["CPUExecutionProvider"])
-            input_name = ort_session.get_inputs()[0].name
-            print("✅ Model loaded successfully and ready for predictions.")
+            await run_batch(loop, executor, index, batch, timeout)
         except Exception as e:
-            print(f"❌ Failed to load ONNX model: {e}")
-    else:
-        print("⚠️ No model loaded. The API will still run, but /predict will return an error.")
+            # Never let one bad batch stop the worker; fail whatever is
+            # still pending in it and move on to the next one
+            print(f"❌ Batch worker {index} error: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+async def run_batch(loop, executor, index, batch, timeout):
+    """
+    Fills `batch` up to MAX_BATCH from the queue, runs it on shard `index`
+    and resolves each request's future with its prediction.
+    """
+    deadline = loop.time() + timeout
+
+    # Keep gathering until the batch is full or the timeout expires.
+    # Requests already queued are taken without awaiting; wait_for (which
+    # schedules a task per call) is only used once the queue is empty.
+    while len(batch) < MAX_BATCH:
+        try:
+            batch.append(request_queue.get_nowait())
+            continue
+        except asyncio.QueueEmpty:
+            pass
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(request_queue.get(), timeout=remaining))
+        except asyncio.TimeoutError:
+            break
+
+    # Take the model reference once so a concurrent reload cannot swap
+    # it out mid-batch
+    shard = loaded_model.shards[index]
+
+    # Skip requests whose caller has already gone away
+    batch = [(values, future) for values, future in batch if not future.done()]
+    if not batch:
+        return
+
+    # Write the whole batch into the shard's buffer with one numpy assignment
+    rows, futures = zip(*batch)
+    try:
+        shard.input_buf[:len(rows)] = rows
+    except (TypeError, ValueError):
+        # Fall back to row by row so a malformed row only fails its
+        # own request, not the whole batch
+        futures = []
+        for values, future in batch:
+            try:
+                shard.input_buf[len(futures)] = values
+            except (TypeError, ValueError) as e:
+                if not future.done():
+                    future.set_exception(ValueError(f"Invalid feature values: {e}"))
+                continue
+            futures.append(future)
+
+    n = len(futures)
+    if n == 0:
+        return
+
+    # numpy turns null into NaN on assignment; fail rows that are not all
+    # finite and move the remaining ones up so the buffer stays contiguous
+    finite = np.isfinite(shard.input_buf[:n]).all(axis=1)
+    if not finite.all():
+        for future in compress(futures, ~finite):
+            if not future.done():
+                future.set_exception(ValueError("Invalid feature values: features must be finite numbers"))
+        futures = list(compress(futures, finite))
+        shard.input_buf[:len(futures)] = shard.input_buf[:n][finite]
+        n = len(futures)
+        if n == 0:
+            return
+
+    try:
+        await loop.run_in_executor(executor, shard.run, n)
+    except Exception as e:
+        print(f"❌ Batch inference failed: {e}")
+        for future in futures:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    for future, predicted_value in zip(futures, shard.output_buf[:n, 0].tolist()):
+        if not future.done():
+            future.set_result(predicted_value)
+
+
+def latest_stage_model(cur):
+    """
+    Returns (file_name, md5) of the newest .onnx file on the stage, or None.
+    LIST is served by Snowflake's cloud services layer, so polling it never
+    resumes the warehouse.
+    """
+    cur.execute(f"LIST @{FULL_STAGE_PATH} PATTERN='.*[.]onnx'")
+    latest_file = latest_stage_file(cur.fetchall())
+    if not latest_file:
+        return None
+    return os.path.basename(latest_file[0]), latest_file[2]
+
+
+def watch_model_stage():
+    """
+    Background thread: polls the stage listing and only when a new model
+    lands downloads it and swaps it in. /predict keeps serving the previous
+    model until the new one is fully loaded, then its files are removed.
+    """
+    global loaded_model
+    conn = None
+
+    # Start from the stage file the loaded model came from, so the first
+    # check does not reload a model that is already being served
+    current = loaded_model
+    last_seen = current.stage_file if current else None
+
+    try:
+        while not watcher_stop.wait(MODEL_WATCH_INTERVAL_S):
+            try:
+                if conn is None or conn.is_closed():
+                    conn = connect_to_snowflake()
+
+                latest = latest_stage_model(conn.cursor())
+                if not latest or latest == last_seen:
+                    continue
+
+                print(f"🔔 New model on stage: {latest[0]}")
+                local_model_path, stage_file = download_latest_onnx_model()
+                if not local_model_path or stage_file == last_seen:
+                    continue
+
+                previous = loaded_model
+                loaded_model = build_model(local_model_path, stage_file)
+                print(f"✅ Swapped in new model: {local_model_path}")
+                # Record what was actually downloaded and is now being served,
+                # so a failed download or load is retried on the next check
+                last_seen = stage_file
+
+                if previous and previous.model_path != local_model_path:
+                    remove_model_files(previous.model_path)
+                    print(f"🧹 Removed files of previous model: {previous.model_path}")
+            except snowflake.connector.errors.OperationalError as e:
+                # Connection-level failure: reconnect on the next check
+                print(f"❌ Stage watcher lost its connection: {e}")
+                if conn:
+                    conn.close()
+                conn = None
+            except Exception as e:
+                print(f"❌ Stage watcher error: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+
+async def load_model():
+    """
+    Downloads and loads the model off the event loop so the API can answer
+    health checks while Snowflake and ONNX Runtime are still working.
+    """
+    global loaded_model, watcher_thread
+    try:
+        local_model_path, stage_file = await asyncio.to_thread(download_latest_onnx_model)
+
+        if local_model_path and os.path.exists(local_model_path):
+            try:
+                loaded_model = await asyncio.to_thread(build_model, local_model_path, stage_file)
+                print("✅ Model loaded successfully and ready for predictions.")
+            except Exception as e:
+                print(f"❌ Failed to load ONNX model: {e}")
+        else:
+            print("⚠️ No model loaded. The API will still run, but /predict will return an error.")
+    finally:
+        MODEL_READY.set()
+
+    if MODEL_WATCH_INTERVAL_S > 0:
+        watcher_thread = threading.Thread(target=watch_model_stage, name="model-stage-watcher", daemon=True)
+        watcher_thread.start()
+        print(f"👀 Watching stage for new models every {MODEL_WATCH_INTERVAL_S}s.")
+
+
+@app.on_event("startup")
+async def startup_event():
+    """
+    On startup, start the request batcher and begin loading the latest
+    model in the background.
+    """
+    global request_queue, batch_tasks, shard_executors, model_task
+    print("🚀 Starting FastAPI Server — initializing model...")
+
+    request_queue = asyncio.Queue()
+    shard_executors = [create_shard_executor(i) for i in range(ORT_SESSION_POOL_SIZE)]
+    batch_tasks = [asyncio.create_task(batch_worker(i)) for i in range(ORT_SESSION_POOL_SIZE)]
+    print(
+        f"📦 Request batcher started (max_batch={MAX_BATCH}, timeout={BATCH_TIMEOUT_MS}ms, "
+        f"sessions={ORT_SESSION_POOL_SIZE})."
+    )
+
+    model_task = asyncio.create_task(load_model())
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """
+    On shutdown, stop the stage watcher and the shard executors.
+    """
+    watcher_stop.set()
+    for executor in shard_executors:
+        executor.shutdown(wait=False)
+
+
+def quantize_features(values):
+    """
+    Snaps a row of feature values onto the cache grid and returns
+    (key, snapped_row), or (None, values) if the values are not finite
+    numbers (the batcher reports those as errors).
+    """
+    try:
+        key = tuple([round(value / step) for value, step in zip(values, FEATURE_CACHE_STEPS)])
+    except (TypeError, ValueError, OverflowError):
+        return None, values
+    return key, [index * step for index, step in zip(key, FEATURE_CACHE_STEPS)]
+
+
+async def enqueue_prediction(values):
+    """
+    Hands one row of feature values (in FEATURE_NAMES order) to the batcher
+    and waits for its prediction. With the cache enabled the row is snapped
+    to the cache grid first, and rows on a recently seen grid point are
+    answered from the model's LRU cache without ORT.
+    """
+    model = loaded_model
+    cache = model.prediction_cache
+    key = None
+    if PREDICTION_CACHE_SIZE > 0:
+        key, values = quantize_features(values)
+
+    if key is not None:
+        predicted_value = cache.get(key)
+        if predicted_value is not None:
+            cache.move_to_end(key)
+            return predicted_value
+
+    future = asyncio.get_running_loop().create_future()
+    request_queue.put_nowait((values, future))
+    predicted_value = await future
+
+    if key is not None:
+        cache[key] = predicted_value
+        if len(cache) > PREDICTION_CACHE_SIZE:
+            cache.popitem(last=False)
+    return predicted_value
 
 
 @app.get("/", summary="API Health Check")
@@ -145,32 +830,79 @@ def health_check():
     """
     Health check endpoint to verify server and model status.
     """
-    status = "loaded" if ort_session else "not loaded"
+    if not MODEL_READY.is_set():
+        status = "warming"
+    else:
+        status = "loaded" if loaded_model else "not loaded"
     return {"status": "ok", "model_status": status}
 
 
-@app.post("/predict", summary="Predict Power Consumption")
-def predict(features: InputFeatures):
+@app.post(
+    "/predict",
+    summary="Predict Power Consumption",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": INPUT_FEATURES_SCHEMA}}
+        },
+        "responses": {"422": VALIDATION_ERROR_RESPONSE}
+    }
+)
+async def predict(features: InputFeatures = Depends(parse_features)):
     """
     Receives JSON input and returns power consumption prediction.
+    Requests are queued and answered by the batcher.
+    """
+    await MODEL_READY.wait()
+    if not loaded_model:
+        return {"error": "Model not loaded. Please check server logs."}
+
+    try:
+        predicted_value = await enqueue_prediction(features_from_model(features))
+    except ValueError as e:
+        # e.g. "nan"/"inf" strings, which the lax decode coerces to floats
+        raise RequestValidationError([{"type": "finite_number", "loc": ["body"], "msg": str(e)}])
+    return {"predicted_power_consumption": predicted_value}
+
+
+@app.post("/predict_fast", summary="Predict Power Consumption (unvalidated)")
+async def predict_fast(request: Request):
+    """
+    Same contract as /predict, but parses the body with orjson and skips
+    schema validation. Intended for trusted internal callers. Numeric
+    strings are coerced to floats; null, NaN and infinite values, and
+    anything else that is not a number, are rejected with a 400.
     """
-    if not ort_session:
+    await MODEL_READY.wait()
+    if not loaded_model:
         return {"error": "Model not loaded. Please check server logs."}
 
-    ordered_features = [
-        features.TEMPERATURE, features.HUMIDITY, features.WINDSPEED,
-        features.GENERALDIFFUSEFLOWS, features.DIFFUSEFLOWS, features.HOUR,
-        features.DAYOFWEEK, features.QUARTER, features.MONTH, features.DAYOFYEAR,
-        features.POWER_LAG_1, features.POWER_LAG_144,
-        features.POWER_ROLLING_MEAN_6, features.POWER_ROLLING_MEAN_24
-    ]
-
-    input_array = np.array(ordered_features, dtype=np.float32).reshape(1, -1)
-    prediction = ort_session.run(None, {input_name: input_array})[0]
-    predicted_value = float(prediction[0][0])
+    try:
+        values = features_from_dict(orjson.loads(await request.body()))
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {e}")
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Missing feature: {e}")
+    except TypeError:
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object.")
+
+    try:
+        predicted_value = await enqueue_prediction(values)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"predicted_power_consumption": predicted_value}
 
 
 if __name__ == "__main__":
-    print("✅ FastAPI running on http://0.0.0.0:8055")
-    uvicorn.run(app, host="0.0.0.0", port=8055)
+    if UVICORN_WORKERS > 1:
+        # Sync the model once so the workers find it in place and skip the GET
+        download_latest_onnx_model()
+    print(f"✅ FastAPI running on http://0.0.0.0:8055 with {UVICORN_WORKERS} worker(s)")
+    uvicorn.run(
+        "serve_model:app",
+        host="0.0.0.0",
+        port=8055,
+        workers=UVICORN_WORKERS,
+        loop="auto",
+        http="auto"
+    )
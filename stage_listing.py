@@ -0,0 +1,31 @@
+# --- Helpers for reading Snowflake stage LIST output ---
+# Shared by trigger_pipeline.py and serve_model.py so both agree on which
+# stage file is the latest one.
+
+_MONTHS = {
+    "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12
+}
+
+
+def parse_stage_timestamp(last_modified):
+    """
+    Parses LIST's last_modified column ("Tue, 7 Oct 2025 21:35:12 GMT")
+    into a (year, month, day, hour, minute, second) tuple that sorts
+    chronologically. Much cheaper than datetime.strptime for the fixed
+    format the stage always returns.
+    """
+    _, day, month, year, clock, _ = last_modified.split(" ")
+    hour, minute, second = clock.split(":")
+    return int(year), _MONTHS[month], int(day), int(hour), int(minute), int(second)
+
+
+def latest_stage_file(stage_files):
+    """
+    Returns the newest row of a LIST result (name, size, md5, last_modified),
+    or None if it is empty. Ties are broken by name, so every caller picks
+    the same file.
+    """
+    if not stage_files:
+        return None
+    return max(stage_files, key=lambda x: (parse_stage_timestamp(x[3]), x[0]))
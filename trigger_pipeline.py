@@ -1,7 +1,9 @@
 import snowflake.connector
 import os
+import sys
+import atexit
 from dotenv import load_dotenv
-import time
+from stage_listing import latest_stage_file
 
 load_dotenv()
 
@@ -14,6 +16,9 @@ SNOWFLAKE_DATABASE = os.getenv("SNOWFLAKE_DATABASE", "POWERCONSUMPTION")
 SNOWFLAKE_SCHEMA = os.getenv("SNOWFLAKE_SCHEMA", "PUBLIC")
 SNOWFLAKE_STAGE = os.getenv("SNOWFLAKE_STAGE", "ML_MODELS_STAGE")
 
+# Upper bound (seconds) for the whole multi-statement pipeline request; 0 means no limit
+PIPELINE_TIMEOUT_S = int(os.getenv("PIPELINE_TIMEOUT_S", "0"))
+
 # --- Define pipeline steps (Stored Procedures) ---
 PIPELINE_STEPS = [
     "CALL POWER_CONSUMPTION_DATA_INGESTION();",
@@ -23,33 +28,71 @@ PIPELINE_STEPS = [
 ]
 
 
+# --- Process-wide Snowflake connection ---
+_CONN = None
+
+
+def get_conn():
+    """
+    Returns the shared Snowflake connection, opening it on first use or if
+    it has been closed, so repeated triggers skip the auth handshake.
+    """
+    global _CONN
+    if _CONN is None or _CONN.is_closed():
+        print("🔗 Connecting to Snowflake...")
+        _CONN = snowflake.connector.connect(
+            user=SNOWFLAKE_USER,
+            password=SNOWFLAKE_PASSWORD,
+            account=SNOWFLAKE_ACCOUNT,
+            warehouse=SNOWFLAKE_WAREHOUSE,
+            database=SNOWFLAKE_DATABASE,
+            schema=SNOWFLAKE_SCHEMA,
+            client_session_keep_alive=True,
+            client_prefetch_threads=4,
+            # No network_timeout: it also caps query run time and would cancel long CALLs
+            session_parameters={"AUTOCOMMIT": True}
+        )
+        print("✅ Connection successful.\n")
+    return _CONN
+
+
+def close_conn():
+    """
+    Closes the shared connection, if one is open. Registered with atexit.
+    """
+    global _CONN
+    if _CONN is not None and not _CONN.is_closed():
+        _CONN.close()
+        print("🔒 Connection closed.")
+    _CONN = None
+
+
+atexit.register(close_conn)
+
+
 def trigger_pipeline():
-    print("🔗 Connecting to Snowflake...")
-
-    # Establish connection
-    conn = snowflake.connector.connect(
-        user=SNOWFLAKE_USER,
-        password=SNOWFLAKE_PASSWORD,
-        account=SNOWFLAKE_ACCOUNT,
-        warehouse=SNOWFLAKE_WAREHOUSE,
-        database=SNOWFLAKE_DATABASE,
-        schema=SNOWFLAKE_SCHEMA
-    )
-    cur = conn.cursor()
-    print("✅ Connection successful.\n")
-
-    # --- Execute each stored procedure step in order ---
-    for idx, step in enumerate(PIPELINE_STEPS, start=1):
-        step_name = step.split("(")[0].replace("CALL ", "").replace("();", "")
-        print(f"🚀 Step {idx}: Executing {step_name} ...")
-        try:
-            cur.execute(step)
+    cur = get_conn().cursor()
+
+    # --- Execute all stored procedure steps in one multi-statement request ---
+    # Statements run in order and CALL blocks until each procedure finishes;
+    # Snowflake stops at the first failing step and execute() raises.
+    step_names = [step.split("(")[0].replace("CALL ", "").replace("();", "") for step in PIPELINE_STEPS]
+    print(f"🚀 Executing {len(PIPELINE_STEPS)} pipeline steps: {', '.join(step_names)} ...")
+    try:
+        cur.execute(
+            "\n".join(PIPELINE_STEPS),
+            num_statements=len(PIPELINE_STEPS),
+            timeout=PIPELINE_TIMEOUT_S or None
+        )
+        for idx, step_name in enumerate(step_names, start=1):
             result = cur.fetchall()
-            print(f"✅ {step_name} executed successfully. Result: {result}\n")
-            time.sleep(2)
-        except Exception as e:
-            print(f"❌ Error in {step_name}: {e}")
-            break
+            print(f"✅ Step {idx}: {step_name} executed successfully. Result: {result}\n")
+            if idx < len(step_names):
+                cur.nextset()
+    except Exception as e:
+        print(f"❌ Error while executing pipeline: {e}")
+        cur.close()
+        return False
 
     # --- Verify stage contents ---
     print("🧠 Checking model stage for latest uploads...")
@@ -62,21 +105,21 @@ def trigger_pipeline():
         else:
             print(f"📦 Found {len(stage_files)} model files in stage @{SNOWFLAKE_STAGE}.\n")
 
-            # Sort files by timestamp (column 3 = last_modified)
-            latest_file = sorted(stage_files, key=lambda x: x[2], reverse=True)[0]
+            # Pick the newest file (LIST columns: name, size, md5, last_modified)
+            latest_file = latest_stage_file(stage_files)
             print(f"✅ Latest model file: {latest_file[0]}")
-            print(f"🕒 Last modified: {latest_file[2]}")
+            print(f"🕒 Last modified: {latest_file[3]}")
             print(f"📏 Size: {round(latest_file[1] / 1024, 2)} KB\n")
 
     except Exception as e:
         print(f"❌ Error while checking model stage: {e}")
 
-    # --- Close connections ---
+    # --- Close cursor (the connection is reused and closed at exit) ---
     cur.close()
-    conn.close()
-    print("🔒 Connection closed.")
     print("🏁 ML pipeline completed successfully!")
+    return True
 
 
 if __name__ == "__main__":
-    trigger_pipeline()
+    # Non-zero exit on failure; the Dockerfile still starts the API unless PIPELINE_REQUIRED=true
+    sys.exit(0 if trigger_pipeline() else 1)